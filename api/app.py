@@ -7,8 +7,8 @@ from starlette.status import HTTP_401_UNAUTHORIZED
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 
 from google.cloud import pubsub_v1
-from common.config import AUTH_USERNAME, AUTH_PASSWORD, PROJECT_ID, PUBSUB_TOPIC
-from common.db import init_schema, list_tasks, get_task, list_targets, insert_task
+from common.config import AUTH_USERNAME, AUTH_PASSWORD, PROJECT_ID, PUBSUB_TOPIC, METRICS_WINDOW_SEC
+from common.db import init_schema, list_tasks, get_task, list_targets, insert_task, stage_metrics, task_status_counts
 from common.storage import signed_log_url
 
 app = FastAPI(title="BugDash")
@@ -74,3 +74,43 @@ def targets(request: Request):
 @app.get("/task/{task_id}/log", response_class=PlainTextResponse)
 def task_log(task_id: str):
     return PlainTextResponse("This deployment stores logs in GCS. Use the signed link from the task page.")
+
+# Gauges over the last METRICS_WINDOW_SEC rather than counters: rows are aggregated on every
+# scrape and deleted tasks cascade into task_stages, so totals could go down and break rate().
+# Every series carries ok="true"/"false" so failed runs never mix into successful ones.
+# (metric name, stage_metrics column, scale, help)
+STAGE_METRICS = [
+    ("bugdash_stage_runs", "runs", 1, "Stage runs that ended in the window"),
+    ("bugdash_stage_wall_seconds", "seconds", 1, "Wall time spent per stage (stage=queue is queue wait)"),
+    ("bugdash_stage_wall_seconds_max", "seconds_max", 1, "Longest single run per stage"),
+    ("bugdash_stage_items_in", "items_in", 1, "Items fed into each stage"),
+    ("bugdash_stage_items_out", "items_out", 1, "New items produced by each stage (katana/gau/wayback: URLs not already known)"),
+    ("bugdash_stage_cpu_user_seconds", "cpu_user", 1, "Subprocess user CPU per stage"),
+    ("bugdash_stage_cpu_system_seconds", "cpu_sys", 1, "Subprocess system CPU per stage"),
+    ("bugdash_stage_max_rss_bytes", "max_rss_kb", 1024,
+     "Peak subprocess RSS per stage; floored at about bugdash_stage_spawn_rss_bytes, which the child inherits before exec"),
+    ("bugdash_stage_spawn_rss_bytes", "spawn_rss_kb", 1024,
+     "Largest RSS of the spawning process when a stage's subprocesses started (floor of max_rss)"),
+    ("bugdash_stage_db_retries", "db_retries", 1, "Locked-DB retries per stage"),
+]
+
+def _label(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    rows = stage_metrics(METRICS_WINDOW_SEC)
+    out = ["# HELP bugdash_metrics_window_seconds Window the bugdash_stage_* gauges cover",
+           "# TYPE bugdash_metrics_window_seconds gauge",
+           f"bugdash_metrics_window_seconds {METRICS_WINDOW_SEC}"]
+    for name, col, scale, help_ in STAGE_METRICS:
+        out.append(f"# HELP {name} {help_}")
+        out.append(f"# TYPE {name} gauge")
+        for r in rows:
+            ok = "true" if r["ok"] else "false"
+            out.append(f'{name}{{stage="{_label(r["stage"])}",ok="{ok}"}} {float(r[col]) * scale}')
+    out.append("# HELP bugdash_tasks Tasks by status")
+    out.append("# TYPE bugdash_tasks gauge")
+    for r in task_status_counts():
+        out.append(f'bugdash_tasks{{status="{_label(r["status"])}"}} {r["n"]}')
+    return PlainTextResponse("\n".join(out) + "\n", media_type="text/plain; version=0.0.4")
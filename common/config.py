@@ -23,3 +23,6 @@ GCS_BUCKET        = os.getenv("GCS_BUCKET", "")
 # Auth for API (use Secret Manager to inject)
 AUTH_USERNAME     = os.getenv("AUTH_USERNAME", "admin")
 AUTH_PASSWORD     = os.getenv("AUTH_PASSWORD", "change-me")
+
+# /metrics aggregates task_stages rows that ended within this window
+METRICS_WINDOW_SEC = int(os.getenv("METRICS_WINDOW_SEC", "3600"))
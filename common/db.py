@@ -30,7 +30,7 @@ def claim_tasks(n: int):
     RETURNING t.id AS id, t.target AS target
     """)
     with engine.begin() as con:
-        return [dict(r) for r in con.execute(sql, {"n": n}).fetchall()]
+        return [dict(r) for r in con.execute(sql, {"n": n}).mappings().all()]
 
 def up_status(task_id, status, note=""):
     with engine.begin() as con:
@@ -67,3 +67,63 @@ def get_task(task_id):
 def list_targets():
     with engine.begin() as con:
         return con.execute(text("SELECT * FROM targets ORDER BY enabled DESC, seed")).mappings().all()
+
+def record_stage(task_id, stage, started_at, items_in=0, items_out=0, cpu_user=0.0, cpu_sys=0.0,
+                 max_rss_kb=0, spawn_rss_kb=0, db_retries=0, ok=True, error=""):
+    """started_at is a unix timestamp; the stage ends now()."""
+    with engine.begin() as con:
+        con.execute(text("""
+          INSERT INTO task_stages(task_id, stage, started_at, ended_at, items_in, items_out,
+                                  cpu_user, cpu_sys, max_rss_kb, spawn_rss_kb, db_retries, ok, error)
+          VALUES(:id, :st, to_timestamp(:t0), now(), :i, :o, :cu, :cs, :rss, :srss, :r, :ok, :err)
+        """), {"id": task_id, "st": stage, "t0": started_at, "i": items_in, "o": items_out,
+               "cu": cpu_user, "cs": cpu_sys, "rss": max_rss_kb, "srss": spawn_rss_kb,
+               "r": db_retries, "ok": ok, "err": error})
+
+def try_record_stage(task_id, stage, started_at, log=print, record=record_stage, **kw):
+    """Record a stage row with `record` (Postgres by default), logging instead of raising:
+    instrumentation must never fail the task or job it measures."""
+    try:
+        record(task_id, stage, started_at, **kw)
+    except Exception as e:
+        log(f"[stages] record {stage} failed task={task_id} err={e}")
+
+def record_queue_wait(task_id, stage="queue", started_at=None):
+    """Time between created_at and now is recorded as the task's `stage` row, once: Pub/Sub
+    redeliveries and reruns must not add waits that include earlier runs. Takes record_stage's
+    leading arguments so it can go through try_record_stage; started_at is always created_at."""
+    with engine.begin() as con:
+        con.execute(text("""
+          INSERT INTO task_stages(task_id, stage, started_at, ended_at)
+          SELECT id, :st, created_at, now() FROM tasks
+          WHERE id=:id
+            AND NOT EXISTS (SELECT 1 FROM task_stages WHERE task_id=:id AND stage=:st)
+        """), {"id": task_id, "st": stage})
+
+def stage_metrics(window_sec):
+    """Per-stage aggregates over stages that ended in the last window_sec seconds,
+    split by ok so failed runs don't mix into the successful ones."""
+    with engine.begin() as con:
+        return con.execute(text("""
+          SELECT stage, ok,
+                 count(*) AS runs,
+                 COALESCE(sum(EXTRACT(EPOCH FROM (ended_at - started_at))), 0) AS seconds,
+                 COALESCE(max(EXTRACT(EPOCH FROM (ended_at - started_at))), 0) AS seconds_max,
+                 COALESCE(sum(items_in), 0) AS items_in,
+                 COALESCE(sum(items_out), 0) AS items_out,
+                 COALESCE(sum(cpu_user), 0) AS cpu_user,
+                 COALESCE(sum(cpu_sys), 0) AS cpu_sys,
+                 COALESCE(max(max_rss_kb), 0) AS max_rss_kb,
+                 COALESCE(max(spawn_rss_kb), 0) AS spawn_rss_kb,
+                 COALESCE(sum(db_retries), 0) AS db_retries
+          FROM task_stages
+          WHERE ended_at > now() - make_interval(secs => :w)
+          GROUP BY stage, ok
+          ORDER BY stage, ok DESC
+        """), {"w": window_sec}).mappings().all()
+
+def task_status_counts():
+    with engine.begin() as con:
+        return con.execute(text(
+            "SELECT status, count(*) AS n FROM tasks GROUP BY status ORDER BY status"
+        )).mappings().all()
@@ -0,0 +1,22 @@
+import os, subprocess
+
+def rss_kb():
+    """Current resident set size of this process in KiB (0 where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def run_rusage(args, **popen_kw):
+    """Run a command to completion and return (returncode, rusage, spawn_rss_kb) for that child alone.
+    The child is reaped with os.wait4, so runs in other threads don't bleed into the numbers;
+    on Linux the rusage includes the descendants the child waited for (e.g. a shell's tool).
+    ru_maxrss also includes the memory the child inherited from this process before exec, so
+    it is floored at about spawn_rss_kb (this process's RSS at spawn); only values above that
+    are the command's own."""
+    spawn_rss = rss_kb()
+    p = subprocess.Popen(args, **popen_kw)
+    _, status, ru = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return p.returncode, ru, spawn_rss
@@ -46,3 +46,22 @@ CREATE TABLE IF NOT EXISTS findings(
 );
 CREATE INDEX IF NOT EXISTS findings_sev_score ON findings (severity, score DESC);
 CREATE INDEX IF NOT EXISTS findings_raw_gin ON findings USING GIN (raw);
+
+CREATE TABLE IF NOT EXISTS task_stages(
+  id BIGSERIAL PRIMARY KEY,
+  task_id TEXT REFERENCES tasks(id) ON DELETE CASCADE,
+  stage TEXT NOT NULL,
+  started_at TIMESTAMPTZ NOT NULL,
+  ended_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  items_in INT DEFAULT 0,
+  items_out INT DEFAULT 0,
+  cpu_user DOUBLE PRECISION DEFAULT 0,
+  cpu_sys DOUBLE PRECISION DEFAULT 0,
+  max_rss_kb BIGINT DEFAULT 0,
+  spawn_rss_kb BIGINT DEFAULT 0,
+  db_retries INT DEFAULT 0,
+  ok BOOLEAN NOT NULL DEFAULT TRUE,
+  error TEXT DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS task_stages_ended ON task_stages (ended_at);
+CREATE INDEX IF NOT EXISTS task_stages_task ON task_stages (task_id);
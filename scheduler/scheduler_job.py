@@ -1,7 +1,8 @@
-import os, time, hashlib, requests, json
+import os, time, hashlib, requests, json, resource
 from sqlalchemy import create_engine, text
 from google.cloud import pubsub_v1
 from common.config import DATABASE_URL, PROJECT_ID, PUBSUB_TOPIC
+from common.db import try_record_stage
 engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 publisher = pubsub_v1.PublisherClient()
 topic_path = publisher.topic_path(PROJECT_ID, PUBSUB_TOPIC)
@@ -16,7 +17,16 @@ def normalize(p):
     seed = p[2:] if p.startswith("*.") else (p.split(".",1)[1] if p.startswith("*-") and "." in p else p.lstrip("*."))
     return p, seed
 
+def record(stage, t0, ru0, items_in, items_out):
+    """Scheduler runs aren't tasks, so their stages have task_id NULL. CPU is this process's
+    delta; no RSS, since RUSAGE_SELF only has the lifetime peak."""
+    ru1 = resource.getrusage(resource.RUSAGE_SELF)
+    try_record_stage(None, stage, t0, items_in=items_in, items_out=items_out,
+                     cpu_user=ru1.ru_utime - ru0.ru_utime, cpu_sys=ru1.ru_stime - ru0.ru_stime)
+
 def merge_targets():
+    t0 = time.time(); ru0 = resource.getrusage(resource.RUSAGE_SELF)
+    added = 0
     try:
         r = requests.get(ARK_URL, timeout=20); r.raise_for_status()
         lines = r.text.splitlines()
@@ -27,10 +37,11 @@ def merge_targets():
             nz = normalize(ln)
             if not nz: continue
             pat, seed = nz
-            con.execute(text("INSERT INTO targets(pattern,seed) VALUES(:p,:s) ON CONFLICT DO NOTHING"),
-                        {"p": pat, "s": seed})
+            added += con.execute(text("INSERT INTO targets(pattern,seed) VALUES(:p,:s) ON CONFLICT DO NOTHING"),
+                                 {"p": pat, "s": seed}).rowcount
             con.execute(text("INSERT INTO scope(pattern) VALUES(:p) ON CONFLICT DO NOTHING"),
                         {"p": pat})
+    record("scheduler:merge_targets", t0, ru0, len(lines), added)
 
 def enqueue_due():
     sel = text("""
@@ -40,16 +51,19 @@ def enqueue_due():
       ORDER BY (last_scanned IS NOT NULL), last_scanned ASC
       LIMIT :lim
     """)
+    t0 = time.time(); ru0 = resource.getrusage(resource.RUSAGE_SELF)
+    added = 0
     with engine.begin() as con:
         rows = con.execute(sel, {"cd": COOLDOWN_SEC, "lim": MAX_BATCH}).fetchall()
         for r in rows:
             tid = hashlib.sha1(f"{r.id}-{time.time()}".encode()).hexdigest()[:12]
-            con.execute(text("""
+            added += con.execute(text("""
               INSERT INTO tasks(id,target,created_at,status,note)
               VALUES(:id,:t,now(),'queued',:note)
               ON CONFLICT DO NOTHING
-            """), {"id": tid, "t": r.seed, "note": f"auto: {r.pattern}"})
+            """), {"id": tid, "t": r.seed, "note": f"auto: {r.pattern}"}).rowcount
             publisher.publish(topic_path, json.dumps({"task_id": tid, "target": r.seed}).encode())
+    record("scheduler:enqueue", t0, ru0, len(rows), added)
 
 if __name__ == "__main__":
     merge_targets()
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
-import os, sys, subprocess, json, sqlite3, hashlib, time, tempfile, shlex, re, urllib.parse, random
+import os, sys, json, sqlite3, hashlib, time, tempfile, shlex, re, urllib.parse, random
+from contextlib import contextmanager
+from common.db import record_stage, try_record_stage
+from common.proc import run_rusage
 
 DB_PATH = os.getenv("DB_PATH", "/data/bugdash.db")
 NUCLEI_TEMPLATES_DIR = os.getenv("NUCLEI_TEMPLATES_DIR", "/data/nuclei-templates")
 CUSTOM_TEMPLATES_DIR = os.getenv("CUSTOM_TEMPLATES_DIR", "/data/custom-templates")
 LOG_DIR = "/var/log/bugdash"
+# where task_stages rows go: "postgres" (Cloud worker) or "sqlite" (DB_PATH, set by supervisor.py)
+STAGES_DB = os.getenv("STAGES_DB", "postgres")
 
 # ---------- DB helpers (WAL + retries) ----------
 def db():
@@ -35,15 +40,28 @@ def db():
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         pattern TEXT UNIQUE
     )""")
+    con.execute("""CREATE TABLE IF NOT EXISTS task_stages(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id TEXT, stage TEXT, started_at REAL, ended_at REAL,
+        items_in INTEGER DEFAULT 0, items_out INTEGER DEFAULT 0,
+        cpu_user REAL DEFAULT 0, cpu_sys REAL DEFAULT 0,
+        max_rss_kb INTEGER DEFAULT 0, spawn_rss_kb INTEGER DEFAULT 0,
+        db_retries INTEGER DEFAULT 0, ok INTEGER DEFAULT 1, error TEXT DEFAULT ''
+    )""")
     return con
 
+DB_RETRIES = 0  # locked/busy retries in this process, read by stage()
+CUR_STAGE = None  # stats dict of the open stage(); sh() adds each child's rusage to it
+
 def _exec_retry(con, sql, params=(), attempts=10):
+    global DB_RETRIES
     for i in range(attempts):
         try:
             return con.execute(sql, params)
         except sqlite3.OperationalError as e:
             msg = str(e).lower()
             if "database is locked" in msg or "database is busy" in msg:
+                DB_RETRIES += 1
                 time.sleep((0.025 * (2 ** i)) + random.uniform(0, 0.010))
                 continue
             raise
@@ -68,6 +86,45 @@ def insert_finding(task_id, tool, fp, title, detail, severity, label, raw, scope
             (task_id, tool, fp, title, detail, severity, label, json.dumps(raw), int(score), reasons)
         )
 
+def record_stage_sqlite(task_id, stage, started_at, items_in=0, items_out=0, cpu_user=0.0, cpu_sys=0.0,
+                        max_rss_kb=0, spawn_rss_kb=0, db_retries=0, ok=True, error=""):
+    """SQLite twin of common.db.record_stage for the supervisor/DB_PATH setup; the stage ends now."""
+    with db() as con:
+        _exec_retry(con,
+            """INSERT INTO task_stages(task_id,stage,started_at,ended_at,items_in,items_out,cpu_user,cpu_sys,
+                                       max_rss_kb,spawn_rss_kb,db_retries,ok,error)
+               VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (task_id, stage, started_at, time.time(), int(items_in), int(items_out), cpu_user, cpu_sys,
+             int(max_rss_kb), int(spawn_rss_kb), int(db_retries), int(bool(ok)), error)
+        )
+
+@contextmanager
+def stage(task_id, name, items_in=0):
+    """Set the task note to `name` and record timing, item counts, child CPU/RSS and DB retries
+    as a task_stages row. The caller fills st["in"] / st["out"]; sh() fills cpu/rss.
+    A stage whose body raises is recorded with ok=False and the error, then re-raised."""
+    global CUR_STAGE
+    up_status(task_id, "running", name)
+    st = {"in": items_in, "out": 0, "cpu_user": 0.0, "cpu_sys": 0.0, "rss": 0, "spawn_rss": 0}
+    t0 = time.time(); r0 = DB_RETRIES; err = None
+    CUR_STAGE = st
+    try:
+        yield st
+    except BaseException as e:
+        err = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        CUR_STAGE = None
+        retries = DB_RETRIES - r0
+        log(task_id, f"[stage] {name} {'ok' if err is None else 'FAILED'} {time.time() - t0:.1f}s "
+                     f"in={st['in']} out={st['out']} cpu={st['cpu_user']:.1f}u/{st['cpu_sys']:.1f}s "
+                     f"rss={st['rss']}KiB (spawn {st['spawn_rss']}KiB) db_retries={retries}")
+        try_record_stage(task_id, name, t0, log=lambda m: log(task_id, m),
+                         record=record_stage_sqlite if STAGES_DB == "sqlite" else record_stage,
+                         items_in=st["in"], items_out=st["out"], cpu_user=st["cpu_user"],
+                         cpu_sys=st["cpu_sys"], max_rss_kb=st["rss"], spawn_rss_kb=st["spawn_rss"],
+                         db_retries=retries, ok=err is None, error=err or "")
+
 # ---------- utils ----------
 def log_start(task_id):
     os.makedirs(LOG_DIR, exist_ok=True)
@@ -81,12 +138,24 @@ def log(task_id, msg):
 def sh(task_id, desc, cmd, inp=None):
     """Run a shell command, tee stderr to the task log, return stdout (text)."""
     log(task_id, f"$ {cmd}")
-    p = subprocess.run(cmd, input=inp, text=True, shell=True, capture_output=True)
-    if p.stderr:
-        log(task_id, p.stderr.strip())
-    if p.returncode != 0:
-        log(task_id, f"{desc} exited rc={p.returncode} (continuing)")
-    return p.stdout or ""
+    # spool through temp files so the child can be reaped with wait4 for its own rusage
+    with tempfile.TemporaryFile("w+") as fin, tempfile.TemporaryFile("w+") as fout, \
+         tempfile.TemporaryFile("w+") as ferr:
+        if inp is not None:
+            fin.write(inp); fin.flush(); fin.seek(0)
+        rc, ru, spawn_rss = run_rusage(cmd, shell=True, stdin=fin if inp is not None else None, stdout=fout, stderr=ferr)
+        fout.seek(0); ferr.seek(0)
+        out, err = fout.read(), ferr.read()
+    if CUR_STAGE is not None:
+        CUR_STAGE["cpu_user"] += ru.ru_utime
+        CUR_STAGE["cpu_sys"] += ru.ru_stime
+        CUR_STAGE["rss"] = max(CUR_STAGE["rss"], ru.ru_maxrss)
+        CUR_STAGE["spawn_rss"] = max(CUR_STAGE["spawn_rss"], spawn_rss)
+    if err:
+        log(task_id, err.strip())
+    if rc != 0:
+        log(task_id, f"{desc} exited rc={rc} (continuing)")
+    return out
 
 def normalize_wildcard(line):
     line = line.strip()
@@ -199,70 +268,76 @@ def run(task_id, target):
     up_status(task_id, "running", "starting recon")
 
     # 0) subdomains (assetfinder + subfinder)
-    up_status(task_id, "running", "assetfinder/subfinder")
-    subs_af = sh(task_id, "assetfinder", f"assetfinder --subs-only {shlex.quote(target)}")
-    subs_sf = sh(task_id, "subfinder", f"subfinder -silent -d {shlex.quote(target)}")
-    subs_all = set(s.strip() for s in (subs_af.splitlines() + subs_sf.splitlines()) if s.strip())
+    with stage(task_id, "assetfinder/subfinder") as st:
+        subs_af = sh(task_id, "assetfinder", f"assetfinder --subs-only {shlex.quote(target)}")
+        subs_sf = sh(task_id, "subfinder", f"subfinder -silent -d {shlex.quote(target)}")
+        subs_all = set(s.strip() for s in (subs_af.splitlines() + subs_sf.splitlines()) if s.strip())
+        st["out"] = len(subs_all)
 
     # 1) resolve with dnsx
-    up_status(task_id, "running", "dnsx")
-    r = sh(task_id, "dnsx", "dnsx -silent", inp="\n".join(sorted(subs_all))) if subs_all else ""
-    hosts = set(h.strip() for h in r.splitlines() if h.strip())
-    for h in hosts: insert_asset(task_id, "host", h, scope_pats)
+    with stage(task_id, "dnsx", len(subs_all)) as st:
+        r = sh(task_id, "dnsx", "dnsx -silent", inp="\n".join(sorted(subs_all))) if subs_all else ""
+        hosts = set(h.strip() for h in r.splitlines() if h.strip())
+        for h in hosts: insert_asset(task_id, "host", h, scope_pats)
+        st["out"] = len(hosts)
 
     # 2) httpx
-    up_status(task_id, "running", "httpx")
-    httpx_cmd = ("httpx -silent -json -follow-host-redirects -no-color "
-                 "-tech-detect -status-code -content-length -title -web-server -tls-probe "
-                 "-ports 80,443,8080,8443")
-    httpx_out = sh(task_id, "httpx", httpx_cmd, inp="\n".join(hosts))
-    urls = set(); httpx_map = {}
-    for line in httpx_out.splitlines():
-        try:
-            j = json.loads(line); u = j.get("url")
-            if u and in_scope(u, scope_pats):
-                urls.add(u); httpx_map[u] = j; insert_asset(task_id, "url", u, scope_pats)
-        except json.JSONDecodeError:
-            pass
+    with stage(task_id, "httpx", len(hosts)) as st:
+        httpx_cmd = ("httpx -silent -json -follow-host-redirects -no-color "
+                     "-tech-detect -status-code -content-length -title -web-server -tls-probe "
+                     "-ports 80,443,8080,8443")
+        httpx_out = sh(task_id, "httpx", httpx_cmd, inp="\n".join(hosts))
+        urls = set(); httpx_map = {}
+        for line in httpx_out.splitlines():
+            try:
+                j = json.loads(line); u = j.get("url")
+                if u and in_scope(u, scope_pats):
+                    urls.add(u); httpx_map[u] = j; insert_asset(task_id, "url", u, scope_pats)
+            except json.JSONDecodeError:
+                pass
+        st["out"] = len(urls)
 
     # 3) katana + gau + wayback
-    up_status(task_id, "running", "katana/gau/wayback")
-    kat = sh(task_id, "katana", "katana -silent -jc -ef png,jpg,svg,css,woff,ico -d 2 -kf", inp="\n".join(urls))
-    for line in kat.splitlines():
-        try:
-            j = json.loads(line)
-            u = j.get("request","").split(" ")[1] if "request" in j else j.get("url") or j.get("source")
-            if u and in_scope(u, scope_pats):
-                urls.add(u); insert_asset(task_id, "url", u, scope_pats)
-        except Exception:
-            pass
-    gau_out = sh(task_id, "gau", f"gau --threads 20 --subs --providers wayback,commoncrawl,otx {shlex.quote(target)}")
-    wb_out  = sh(task_id, "waybackurls", f"waybackurls {shlex.quote(target)}")
-    for u in (gau_out.splitlines() + wb_out.splitlines()):
-        if u.startswith("http") and in_scope(u, scope_pats):
-            uu = u.strip(); urls.add(uu); insert_asset(task_id, "url", uu, scope_pats)
+    with stage(task_id, "katana/gau/wayback", len(urls)) as st:
+        n_known = len(urls)
+        kat = sh(task_id, "katana", "katana -silent -jc -ef png,jpg,svg,css,woff,ico -d 2 -kf", inp="\n".join(urls))
+        for line in kat.splitlines():
+            try:
+                j = json.loads(line)
+                u = j.get("request","").split(" ")[1] if "request" in j else j.get("url") or j.get("source")
+                if u and in_scope(u, scope_pats):
+                    urls.add(u); insert_asset(task_id, "url", u, scope_pats)
+            except Exception:
+                pass
+        gau_out = sh(task_id, "gau", f"gau --threads 20 --subs --providers wayback,commoncrawl,otx {shlex.quote(target)}")
+        wb_out  = sh(task_id, "waybackurls", f"waybackurls {shlex.quote(target)}")
+        for u in (gau_out.splitlines() + wb_out.splitlines()):
+            if u.startswith("http") and in_scope(u, scope_pats):
+                uu = u.strip(); urls.add(uu); insert_asset(task_id, "url", uu, scope_pats)
+        st["out"] = len(urls) - n_known  # only URLs this stage added
 
     # 4) nuclei
-    up_status(task_id, "running", "nuclei")
-    with tempfile.NamedTemporaryFile("w", delete=False) as f:
-        f.write("\n".join(sorted(urls)))
-        inlist = f.name
-    all_templates = f"-templates {NUCLEI_TEMPLATES_DIR} -templates {CUSTOM_TEMPLATES_DIR}"
-    nuc = sh(task_id, "nuclei", f"nuclei -silent -jsonl -rate-limit 200 -retry 1 {all_templates} -list {inlist}")
+    with stage(task_id, "nuclei", len(urls)) as st:
+        with tempfile.NamedTemporaryFile("w", delete=False) as f:
+            f.write("\n".join(sorted(urls)))
+            inlist = f.name
+        all_templates = f"-templates {NUCLEI_TEMPLATES_DIR} -templates {CUSTOM_TEMPLATES_DIR}"
+        nuc = sh(task_id, "nuclei", f"nuclei -silent -jsonl -rate-limit 200 -retry 1 {all_templates} -list {inlist}")
 
-    for line in nuc.splitlines():
-        try:
-            j = json.loads(line)
-            name = j.get("info",{}).get("name","")
-            sev  = j.get("info",{}).get("severity","info")
-            matched = j.get("matched-at") or j.get("host") or j.get("url") or ""
-            if not matched or not in_scope(matched, scope_pats): continue
-            hmeta = httpx_map.get(matched) or httpx_map.get(j.get("url","")) or {}
-            score, reasons = calc_score_and_reasons(j, hmeta)
-            tid = j.get("template-id",""); fp = hashit(tid, matched)
-            insert_finding(task_id, "nuclei", fp, name, matched, sev, label_for(sev), j, scope_pats, score, reasons)
-        except Exception as e:
-            log(task_id, f"[parse nuclei] {e}")
+        for line in nuc.splitlines():
+            try:
+                j = json.loads(line)
+                name = j.get("info",{}).get("name","")
+                sev  = j.get("info",{}).get("severity","info")
+                matched = j.get("matched-at") or j.get("host") or j.get("url") or ""
+                if not matched or not in_scope(matched, scope_pats): continue
+                hmeta = httpx_map.get(matched) or httpx_map.get(j.get("url","")) or {}
+                score, reasons = calc_score_and_reasons(j, hmeta)
+                tid = j.get("template-id",""); fp = hashit(tid, matched)
+                insert_finding(task_id, "nuclei", fp, name, matched, sev, label_for(sev), j, scope_pats, score, reasons)
+                st["out"] += 1
+            except Exception as e:
+                log(task_id, f"[parse nuclei] {e}")
 
     up_status(task_id, "done", "complete")
     log(task_id, "task complete")
@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
-import os, sqlite3, time, threading, subprocess, sys
+import os, sqlite3, time, threading, sys
+from common.db import try_record_stage
+from common.proc import run_rusage
+from run_pipeline import record_stage_sqlite
 
 DB_PATH = os.getenv("DB_PATH", "/data/bugdash.db")
 CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "3"))
@@ -20,18 +23,25 @@ def db():
     )""")
     return con
 
+def record(task_id, stage, t0, **kw):
+    # supervisor task ids live in the SQLite tasks table, so their stages stay in DB_PATH too
+    try_record_stage(task_id, stage, t0, log=log, record=record_stage_sqlite, **kw)
+
 def claim_tasks(n):
     claimed = []
     with db() as con:
         rows = con.execute(
-            "SELECT id,target FROM tasks WHERE status='queued' ORDER BY created_at ASC LIMIT ?",
+            "SELECT id,target,created_at FROM tasks WHERE status='queued' ORDER BY created_at ASC LIMIT ?",
             (n,)
         ).fetchall()
-        for tid, tgt in rows:
+        for tid, tgt, created in rows:
             cur = con.execute("UPDATE tasks SET status='running', note='starting' WHERE id=? AND status='queued'", (tid,))
             if cur.rowcount == 1:
-                claimed.append((tid, tgt))
-    return claimed
+                claimed.append((tid, tgt, created))
+    # time spent in 'queued' is recorded as its own stage
+    for tid, _, created in claimed:
+        record(tid, "queue", float(created or 0) or time.time())
+    return [(tid, tgt) for tid, tgt, _ in claimed]
 
 def mark_done(task_id, ok=True, msg="complete"):
     with db() as con:
@@ -46,11 +56,17 @@ def update_target_last_scanned(seed):
 def run_one(task_id, target):
     log(f"[supervisor] run start task={task_id} target={target}")
     try:
-        p = subprocess.run(["python3","/usr/local/bin/run_pipeline.py", task_id, target], check=False)
-        ok = (p.returncode == 0)
-        mark_done(task_id, ok, "complete" if ok else f"exit:{p.returncode}")
+        t0 = time.time()
+        rc, ru, spawn_rss = run_rusage(["python3","/usr/local/bin/run_pipeline.py", task_id, target],
+                                       env=dict(os.environ, STAGES_DB="sqlite"))
+        t1 = time.time()
+        record(task_id, "pipeline", t0, cpu_user=ru.ru_utime, cpu_sys=ru.ru_stime, max_rss_kb=ru.ru_maxrss,
+               spawn_rss_kb=spawn_rss, ok=(rc == 0), error="" if rc == 0 else f"exit:{rc}")
+        ok = (rc == 0)
+        mark_done(task_id, ok, "complete" if ok else f"exit:{rc}")
         update_target_last_scanned(target)
-        log(f"[supervisor] run done  task={task_id} rc={p.returncode}")
+        log(f"[supervisor] run done  task={task_id} rc={rc} "
+            f"wall={t1 - t0:.0f}s cpu={ru.ru_utime + ru.ru_stime:.0f}s rss={ru.ru_maxrss}KiB")
     except Exception as e:
         mark_done(task_id, False, f"err:{e}")
         log(f"[supervisor] run error task={task_id} err={e}")
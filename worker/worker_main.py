@@ -1,16 +1,23 @@
-import os, json, subprocess, threading
+import os, json, threading, time
 from google.cloud import pubsub_v1
-from common.db import claim_tasks, up_status
+from common.db import claim_tasks, up_status, record_queue_wait, try_record_stage
+from common.proc import run_rusage
 from common.storage import upload_task_log
 from common.config import PROJECT_ID, SUBSCRIPTION
 
 CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY","4"))
 LOG_DIR = "/var/log/bugdash"
 
+def log(msg):
+    print(msg, flush=True)
+
 def run_pipeline(task_id, target):
-    rc = subprocess.run(
-        ["python3","/usr/local/bin/run_pipeline.py", task_id, target]
-    ).returncode
+    try_record_stage(task_id, "queue", None, log=log, record=record_queue_wait)
+    t0 = time.time()
+    rc, ru, spawn_rss = run_rusage(["python3","/usr/local/bin/run_pipeline.py", task_id, target])
+    try_record_stage(task_id, "pipeline", t0, log=log, cpu_user=ru.ru_utime, cpu_sys=ru.ru_stime,
+                     max_rss_kb=ru.ru_maxrss, spawn_rss_kb=spawn_rss,
+                     ok=(rc == 0), error="" if rc == 0 else f"exit:{rc}")
     up_status(task_id, "done" if rc==0 else "error", f"exit:{rc}")
     log_path = f"{LOG_DIR}/task-{task_id}.log"
     upload_task_log(task_id, log_path)